@@ -1,42 +1,261 @@
 import argparse
+import json
 import os
+import time
 from pathlib import Path
 
-import imageio
-import cv2
-import numpy as np
+# imageio, cv2, numpy and map (which needs numpy) are only imported by the
+# parts of build_map that use them so that --help and --dry-run start fast
 
-import map
 
-args = None
+def find_ffmpeg():
+    # the same places imageio_ffmpeg looks for ffmpeg (its env variable,
+    # the binary it comes with, then the PATH) without having to import it
+    if(os.environ.get("IMAGEIO_FFMPEG_EXE")):
+        return os.environ["IMAGEIO_FFMPEG_EXE"]
 
+    import importlib.util
 
-def create_map():
-    if(not os.path.exists(args.vid)):
-        raise IOError("Cannot find video file!")
+    spec = importlib.util.find_spec("imageio_ffmpeg")
+    folders = spec.submodule_search_locations if spec is not None else None
 
-    path = Path(args.c) / Path("Mods/")
+    for folder in folders or []:
+        binaries = os.path.join(folder, "binaries")
 
-    vid = imageio.get_reader(args.vid)
-    fps = vid.get_meta_data(0).get("fps")
+        if(os.path.isdir(binaries)):
+            for name in sorted(os.listdir(binaries)):
+                if(name.startswith("ffmpeg")):
+                    return os.path.join(binaries, name)
 
-    dur = vid.get_meta_data(0).get("duration")
+    import shutil
 
-    if(args.f > fps):
-        raise ValueError("FPS cannot be greater than %s" % fps)
+    return shutil.which("ffmpeg")
 
-    file = map.CelesteMap(path / Path(args.n + ".bin"))
-    world = map.World("bad_apple")
 
-    offset = args.w // 2 + 4
-    w, h = (int((args.w + offset) * (args.f * (round(dur) + 3))),
-            int((args.h + offset)))
+def read_video_info(video):
+    # fps and duration straight from the header ffmpeg prints for "-i" on
+    # its own, which is much quicker than opening the video with imageio
+    import re
+    import subprocess
+
+    exe = find_ffmpeg()
+
+    if(exe is not None):
+        header = subprocess.run([exe, "-hide_banner", "-i", video],
+                                capture_output=True).stderr.decode("utf8", "ignore")
+
+        dur = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", header)
+        fps = re.search(r"Video: .*?(\d+(?:\.\d+)?) fps", header)
+
+        if(dur is not None and fps is not None):
+            return float(fps.group(1)), (int(dur.group(1)) * 3600 +
+                                         int(dur.group(2)) * 60 + float(dur.group(3)))
+
+    # anything the header doesn't say plainly is left to imageio_ffmpeg
+    import imageio_ffmpeg
+
+    frames = imageio_ffmpeg.read_frames(video)
+    try:
+        meta = next(frames)
+    finally:
+        frames.close()
+
+    return meta.get("fps"), meta.get("duration")
+
+
+def read_json(path):
+    if(not os.path.exists(path)):
+        return None
+
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_json(path, data):
+    # written to the side and swapped in so a crash never leaves half a file
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+
+    os.replace(path + ".tmp", path)
+
+
+def write_checkpoint(path, size, frame):
+    write_json(path, {"size": list(size), "frame": frame})
+
+
+def sample_frames(vid, vid_fps, fps, width, height, start=0, wanted=None):
+    # every frame at the output fps from start on (or only the ones in
+    # wanted), resized and thresholded to tiles (True is "b", False is 1),
+    # along with its index. the others are read past without being resized
+    import cv2
+
+    f_count = 0
+    index = 0
+    last = max(wanted) if wanted else -1
+
+    for frame in vid:
+        if(wanted is not None and index > last):
+            return
+
+        if(f_count >= (vid_fps / fps)):
+            if(index >= start and (wanted is None or index in wanted)):
+                print("processing frame!")
+
+                frame = cv2.resize(frame, dsize=(width, height),
+                                   interpolation=cv2.INTER_CUBIC)
+
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+                yield index, frame >= 127
+
+            index += 1
+            f_count = 0
+        f_count += 1
+
+
+def pick_frames(frames, change, max_hold):
+    # keeps a frame only when more than change (0 - 1) of its tiles differ
+    # from the last frame kept, or when the last one has been held for
+    # max_hold frames. only the last kept frame is held on to, returns
+    # [index, frames held for] pairs
+    import numpy as np
+
+    kept = []
+    last = None
+
+    for index, frame in frames:
+        if(last is not None and kept[-1][1] < max_hold and
+                np.count_nonzero(frame != last) <= change * frame.size):
+            kept[-1][1] += 1
+            continue
+
+        kept.append([index, 1])
+        last = frame
+
+    return kept
+
+
+def build_map(video, width, height, fps, name, out_dir, work_dir=None, resume=False, stream=False, dry_run=False, change=None, max_hold=1, background=False, checkpoint_every=10):
+    start = time.perf_counter()
+
+    if(not os.path.exists(video)):
+        raise IOError("Cannot find video file!")
+
+    if(stream and work_dir is not None):
+        raise ValueError("stream cannot be used with work_dir!")
+
+    if(resume and work_dir is None):
+        raise ValueError("resume needs the work_dir of the build to carry on!")
+
+    path = Path(out_dir)
+
+    vid_fps, dur = read_video_info(video)
+
+    if(fps > vid_fps):
+        raise ValueError("FPS cannot be greater than %s" % vid_fps)
+
+    offset = width // 2 + 4
+    w, h = (int((width + offset) * (fps * (round(dur) + 3))),
+            int((height + offset)))
+
+    stats = {
+        "file": str(path / Path(name + ".bin")),
+        "cutscene": str(path / Path("cutscenes/cutscene.lua")),
+        "size": (w, h),
+        # with change the room is cut down to the frames kept, which isn't
+        # known until the video has been read
+        "size_is_upper_bound": change is not None,
+        "frames": 0,
+        "sampled": 0,
+        "compression": 1,
+        "resumed_from": 0,
+        "bytes": 0,
+        "seconds": 0,
+        "camera": None,
+    }
+
+    if(dry_run):
+        stats["seconds"] = time.perf_counter() - start
+        return stats
+
+    import imageio
+    import numpy as np
+
+    import map
+
+    # ids come from these counters, start them again so every build of the
+    # same video comes out the same
+    map.Entity.count = 0
+    map.Room.count = 0
+
+    checkpoint = None
+    kept_file = None
+    saved = None
+    kept = None
+
+    if(work_dir is not None):
+        Path(work_dir).mkdir(parents=True, exist_ok=True)
+        checkpoint = str(Path(work_dir) / Path("checkpoint.json"))
+        kept_file = str(Path(work_dir) / Path("kept.json"))
+
+        if(resume):
+            saved = read_json(checkpoint)
+            kept = read_json(kept_file) if change is not None else None
+        else:
+            for old in [checkpoint, kept_file]:
+                if(os.path.exists(old)):
+                    os.remove(old)
+
+    vid = imageio.get_reader(video)
+
+    if(change is not None):
+        # first pass only works out which frames to keep, the second one
+        # below reads the video again and stamps just those
+        if(kept is None):
+            print("picking frames!")
+            kept = pick_frames(sample_frames(vid, vid_fps, fps, width, height),
+                               change, max(1, round(max_hold * fps)))
+            vid = imageio.get_reader(video)
+
+            # saved once, it doesn't change while the frames are stamped
+            if(kept_file is not None):
+                write_json(kept_file, kept)
+
+        # the room only needs to be as wide as the frames that are kept
+        w = int((width + offset) * (len(kept) + fps * 3))
+        stats["size"] = (w, h)
+        stats["size_is_upper_bound"] = False
+
+    done = 0
+
+    if(saved is not None):
+        if(saved["size"] != [w, h]):
+            raise ValueError("Checkpoint was made for a room of size %s, not %s!" % (
+                saved["size"], [w, h]))
+
+        done = saved["frame"]
+
+    folder = path / Path("cutscenes")
+    folder.mkdir(parents=True, exist_ok=True)
+
+    world = map.World("bad_apple")
 
     print("creating room and floor!")
-    room = map.Room("room_0", size=(w, h))
-    floor = map.Shape.Rect((20, 1), (w, h), (0, h - 1),
-                           type="Stone").to_tiles()
-    room.add_tiles(floor)
+    if(stream):
+        # frames are kept bit packed and the bg rows are only put together
+        # while the map is being written
+        room = map.Room("room_0", size=(w, h), fg=map.SparseTiles((w, h)),
+                        bg=map.FrameStrip((w, h), (width, height),
+                                          (offset // 2, offset // 2), width + offset))
+    else:
+        room = map.Room("room_0", size=(w, h), work_dir=work_dir,
+                        resume=resume and done > 0)
+    floor = map.Shape.Rect((20, 1), (20, 1), type="Stone").to_tiles()
+    room.add_tiles(floor, origin=(0, h - 1))
+
+    # nothing else goes in the fg so it only has to reach the disk once
+    if(checkpoint is not None):
+        room.flush("fg")
 
     print("adding character and triggers!")
     # add spawn point for character
@@ -46,9 +265,6 @@ def create_map():
     room.add_triggers(map.Trigger("luaCutscenes/luaCutsceneTrigger",
                                   {"x": 3, "y": h - 6, "width": 40, "height": 40, "filename": "cutscene", "unskippable": True}, map.Entity.count))
 
-    folder = path / Path("cutscenes")
-    folder.mkdir(parents=True, exists_ok=True)
-
     cut = map.Cutscene(path / Path("cutscenes/cutscene.lua"))
     cut.add_variable("""local X = 0
 local cam = getRoom().Camera""")
@@ -67,55 +283,98 @@ local cam = getRoom().Camera""")
     moveCam()
     enableMovement()""")
 
-    print("creating array for tiles!")
-    b = map.Shape.plain_tile_array((w, h))
+    if(done > 0):
+        print("resuming after frame %s!" % done)
 
-    f_count = 0
     # was playing back at half speed for some bizzare reason
-    delay = (1 / (args.f*2))
-    total_f_count = 0
-
-    for frame in vid:
-        if(f_count >= (fps / args.f)):
-            print("processing frame!")
-
-            frame = cv2.resize(frame, dsize=(args.w, args.h),
-                               interpolation=cv2.INTER_CUBIC)
-
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-            for i, v in np.ndenumerate(frame):
-                # trial and error at its finest
-                origin = (offset // 2 + i[0],
-                          offset // 2 + i[1] + ((args.w + offset) * total_f_count))
-
-                if(v >= 127):
-                    b[origin[0]][origin[1]] = "b"
-                else:
-                    b[origin[0]][origin[1]] = 1
-
-            f_count = 0
-            total_f_count += 1
-        f_count += 1
-
-    cut.add_extra("""function moveCam()
+    delay = (1 / (fps*2))
+
+    if(kept is None):
+        frames = sample_frames(vid, vid_fps, fps, width, height, start=done)
+        positions = None
+    else:
+        # kept frames before done were stamped before the last run stopped
+        frames = sample_frames(vid, vid_fps, fps, width, height,
+                               wanted=set(i for i, steps in kept[done:]))
+        positions = {i: n for n, (i, steps) in enumerate(kept)}
+
+    count = done
+    # frames after the last checkpoint are stamped again on resume, so it is
+    # only worth syncing the grid every checkpoint_every seconds
+    last_checkpoint = time.perf_counter()
+
+    for index, frame in frames:
+        n = index if positions is None else positions[index]
+
+        if(stream):
+            room.room_grid_bg.add_frame(frame)
+        else:
+            tiles = map.Tiles(np.where(frame, "b", "1").tolist())
+
+            # trial and error at its finest
+            origin = (offset // 2 + ((width + offset) * n),
+                      offset // 2)
+            room.add_tiles(tiles, "bg", origin)
+
+        count = n + 1
+
+        if(checkpoint is not None and time.perf_counter() - last_checkpoint >= checkpoint_every):
+            room.flush("bg")
+            write_checkpoint(checkpoint, (w, h), count)
+            last_checkpoint = time.perf_counter()
+
+    if(checkpoint is not None and count > done):
+        room.flush("bg")
+        write_checkpoint(checkpoint, (w, h), count)
+
+    holds = [delay] * count if kept is None else [steps * delay for i, steps in kept]
+    sampled = len(holds) if kept is None else sum(steps for i, steps in kept)
+
+    if(change is None):
+        cut.add_extra("""function moveCam()
     for i=0,{x},{step} do
         X = i
         wait({delay})
     end
-end""".format(x=w * 8, step=((args.w + offset) * 8), delay=delay))
+end""".format(x=w * 8, step=((width + offset) * 8), delay=delay))
+    else:
+        # each kept frame stays up for as long as the frames it stands in for
+        cut.add_variable("local holds = {%s}" % ", ".join("%g" % d for d in holds))
+        cut.add_extra("""function moveCam()
+    local n = 1
+    for i=0,{x},{step} do
+        X = i
+        wait(holds[n] or {delay})
+        n = n + 1
+    end
+end""".format(x=w * 8, step=((width + offset) * 8), delay=delay))
 
-    room.add_tiles(b, "bg")
+    # what the cutscene does with the camera, so the build can be previewed
+    camera = {"x": w * 8, "step": (width + offset) * 8, "y": float(y_pos),
+              "zoom": round(180 / (h*5), 2) if not h < 23 else 1, "delay": delay,
+              "holds": holds if change is not None else None}
 
     world.add_room(room)
 
     cut.write_file()
+
+    # only opened now so a build that fails part way through never leaves
+    # the file (or a background writer thread) open
+    file = map.CelesteMap(path / Path(name + ".bin"), background)
     file.write_file(world)
 
+    stats["frames"] = len(holds)
+    stats["sampled"] = sampled
+    stats["compression"] = sampled / max(len(holds), 1)
+    stats["resumed_from"] = done
+    stats["bytes"] = os.path.getsize(stats["file"])
+    stats["seconds"] = time.perf_counter() - start
+    stats["camera"] = camera
+
+    return stats
 
-def setup():
-    global args  # ew
 
+def setup(argv=None):
     parser = argparse.ArgumentParser(
         description="Creates a Celeste map to play \"Bad Apple!!\"")
 
@@ -131,14 +390,45 @@ def setup():
                         help="Height of of output videp", dest="h")
     parser.add_argument("--frames", "-f", type=int,
                         help="Number of frames per second for output video", dest="f")
-
-    args = parser.parse_args()
-
-
-def main():
-    setup()
-
-    create_map()
-
-
-main()
+    parser.add_argument("--work-dir", "-wd", type=str, default=None,
+                        help="Keep the room grid in files in this folder instead of in memory", dest="wd")
+    parser.add_argument("--resume", "-r", action="store_true",
+                        help="Carry on from the last frame finished in --work-dir", dest="resume")
+    parser.add_argument("--checkpoint-every", "-ce", type=float, default=10,
+                        help="Seconds between saving progress to --work-dir (default 10)", dest="checkpoint_every")
+    parser.add_argument("--stream", "-s", action="store_true",
+                        help="Build the background straight from the frames while writing instead of keeping the whole room", dest="stream")
+    parser.add_argument("--dry-run", "-d", action="store_true",
+                        help="Only read the video's details and print the size of the map that would be made", dest="dry_run")
+    parser.add_argument("--change", "-ch", type=float, default=None,
+                        help="Only keep a frame when more than this fraction (0 - 1) of it has changed, holding the last one until then", dest="change")
+    parser.add_argument("--max-hold", "-mh", type=float, default=1,
+                        help="Longest time in seconds a frame is held for with --change", dest="max_hold")
+    parser.add_argument("--background-write", "-bw", action="store_true",
+                        help="Write the map to disk on a separate thread while it is being encoded", dest="background")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = setup(argv)
+
+    stats = build_map(args.vid, args.w, args.h, args.f, args.n, Path(args.c) / Path("Mods/"),
+                      work_dir=args.wd, resume=args.resume, stream=args.stream, dry_run=args.dry_run,
+                      change=args.change, max_hold=args.max_hold, background=args.background,
+                      checkpoint_every=args.checkpoint_every)
+
+    if(stats["size_is_upper_bound"]):
+        print("room is at most %sx%s tiles" % stats["size"])
+    else:
+        print("room is %sx%s tiles" % stats["size"])
+    if(not args.dry_run):
+        print("wrote %s frames (%s bytes) to %s in %.1fs" % (
+            stats["frames"], stats["bytes"], stats["file"], stats["seconds"]))
+    if(not args.dry_run and args.change is not None):
+        print("kept %s of %s frames (%.2f:1)" % (
+            stats["frames"], stats["sampled"], stats["compression"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,9 @@
 
 import struct
 import math
+import os
+import queue
+import threading
 
 import numpy as np
 
@@ -105,6 +108,9 @@ class Encoder():
             self.f.write(0, "uint8")
             self.f.write(1 if value else 0, "uint8")
 
+        elif(isinstance(value, LazyText)):
+            self.encode_lazy_text(value)
+
         elif(isinstance(value, str)):
             try:
                 index = lookup[value]
@@ -126,30 +132,144 @@ class Encoder():
                 self.f.write(5, "uint8")
                 self.f.write(index, "uint16")
 
+    def encode_lazy_text(self, text):
+        # same choice as the string path in encode_value, but the text is
+        # walked chunk by chunk (once to size it, once to write it) so the
+        # whole thing never has to exist as one string
+        length = len(text)
+        limit = min(length - 1, Encoder.ranges[1]["range"][1])
+        encoded_length = self.run_length_size(text.chunks(), limit)
+
+        if(encoded_length is not None):
+            self.f.write(7, "uint8")
+            self.f.write(encoded_length, "uint16")
+
+            rle = RunLengthEncoder()
+            for chunk in text.chunks():
+                self.f.write(rle.feed(chunk), "plain")
+            self.f.write(rle.flush(), "plain")
+        else:
+            self.f.write(6, "uint8")
+            self.f.write_var_length(length)
+
+            for chunk in text.chunks():
+                self.f.write(chunk.encode('utf8'), "plain")
+
+    def run_length_size(self, chunks, limit):
+        # size of the run length encoding of chunks, or None once it goes
+        # over limit
+        size = 0
+        rle = RunLengthEncoder()
+
+        for chunk in chunks:
+            size += len(rle.feed(chunk))
+            if(size > limit):
+                return None
+
+        size += len(rle.flush())
+        return size if size <= limit else None
+
     def encode_run_length(self, string):
-        count = 0
+        rle = RunLengthEncoder()
+        return rle.feed(string) + rle.flush()
+
+
+class RunLengthEncoder():
+    # run length encoder that can be fed a string a piece at a time, runs
+    # carry over from one piece to the next
+
+    def __init__(self):
+        self.current = None
+        self.count = 0
+
+    def feed(self, string):
         res = []
-        current = ord(string[0])
-        chars = [ord(c[0]) for c in list(string)]
-
-        for char in chars:
-            if (char != current or count == 255):
-                res.append(count)
-                res.append(current)
-                count = 1
-                current = char
-            else:
-                count += 1
 
-        res.append(count)
-        res.append(current)
+        if(self.current is None and len(string)):
+            self.current = ord(string[0])
+
+        for char in [ord(c[0]) for c in list(string)]:
+            if (char != self.current or self.count == 255):
+                res.append(self.count)
+                res.append(self.current)
+                self.count = 1
+                self.current = char
+            else:
+                self.count += 1
 
         return bytes(res)
 
+    def flush(self):
+        if(self.current is None):
+            return bytes()
 
-class Writer():
-    def __init__(self, name):
+        res = bytes([self.count, self.current])
+        self.current = None
+        self.count = 0
+
+        return res
+
+
+class BackgroundFile():
+    # file that collects writes into chunk_size pieces and hands them to a
+    # thread to write out, so encoding carries on while the disk is busy.
+    # at most depth pieces wait at once, anything that goes wrong on the
+    # thread is raised again by the next write or by close
+
+    def __init__(self, name, chunk_size=4 * 1024 * 1024, depth=4):
         self.file = open(name, "wb")
+        self.buffer = bytearray()
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(depth)
+        self.error = None
+
+        self.thread = threading.Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            chunk = self.queue.get()
+            if(chunk is None):
+                return
+
+            # keep taking chunks after an error so write never blocks
+            if(self.error is None):
+                try:
+                    self.file.write(chunk)
+                except BaseException as e:
+                    self.error = e
+
+    def check(self):
+        if(self.error is not None):
+            raise self.error
+
+    def write(self, data):
+        self.check()
+        self.buffer += data
+
+        if(len(self.buffer) >= self.chunk_size):
+            # whole chunks only so every write lands on a chunk boundary
+            size = len(self.buffer) - len(self.buffer) % self.chunk_size
+            self.queue.put(self.buffer[:size])
+            del self.buffer[:size]
+
+    def close(self):
+        try:
+            if(len(self.buffer)):
+                self.queue.put(self.buffer)
+                self.buffer = bytearray()
+
+            self.queue.put(None)
+            self.thread.join()
+        finally:
+            self.file.close()
+
+        self.check()
+
+
+class Writer():
+    def __init__(self, name, background=False):
+        self.file = BackgroundFile(name) if background else open(name, "wb")
 
     def write_string(self, data):
         self.write_var_length(len(data))
@@ -205,11 +325,129 @@ class Writer():
         self.file.close()
 
 
+class Reader():
+    def __init__(self, name):
+        self.file = open(name, "rb")
+
+    def read_string(self):
+        return self.file.read(self.read_var_length()).decode('utf8')
+
+    def read_var_length(self):
+        length = 0
+        shift = 0
+
+        while True:
+            b = self.read_UInt8()
+            length += (b & 127) << shift
+            shift += 7
+
+            if (b & 0b10000000 == 0):
+                return length
+
+    def read_UInt8(self):
+        return struct.unpack("<B", self.file.read(1))[0]
+
+    def read_Uint16(self):
+        return struct.unpack("<H", self.file.read(2))[0]
+
+    def read_Int16(self):
+        return struct.unpack("<h", self.file.read(2))[0]
+
+    def read_Int32(self):
+        return struct.unpack("<i", self.file.read(4))[0]
+
+    def read_Float(self):
+        return struct.unpack("<f", self.file.read(4))[0]
+
+    def read(self, type="string", length=0):
+        if(type == "string"):
+            return self.read_string()
+        elif(type == "uint8"):
+            return self.read_UInt8()
+        elif(type == "uint16"):
+            return self.read_Uint16()
+        elif(type == "int16"):
+            return self.read_Int16()
+        elif(type == "int32"):
+            return self.read_Int32()
+        elif(type == "float"):
+            return self.read_Float()
+        else:
+            return self.file.read(length)
+
+    def close(self):
+        self.file.close()
+
+
+class Decoder():
+    # reverse of Encoder, turns a .bin back into the same kind of nested
+    # dicts that to_formatted_data makes
+
+    def __init__(self, reader):
+        self.f = reader
+
+    def decode_element(self, lookup):
+        element = {"__name": lookup[self.f.read("uint16")]}
+
+        for i in range(0, self.f.read("uint8")):
+            key = lookup[self.f.read("uint16")]
+            element[key] = self.decode_value(lookup)
+
+        children = [self.decode_element(lookup)
+                    for i in range(0, self.f.read("uint16"))]
+
+        if(len(children)):
+            element["__children"] = children
+
+        return element
+
+    def decode_value(self, lookup):
+        type = self.f.read("uint8")
+
+        if(type == 0):
+            return self.f.read("uint8") != 0
+        elif(type in [1, 2, 3]):
+            return self.f.read(Encoder.ranges[type - 1]["type"])
+        elif(type == 4):
+            return self.f.read("float")
+        elif(type == 5):
+            return lookup[self.f.read("uint16")]
+        elif(type == 6):
+            return self.f.read("string")
+        elif(type == 7):
+            length = self.f.read("uint16")
+            return self.decode_run_length(self.f.read("plain", length))
+        else:
+            raise ValueError("Unknown value type %s" % type)
+
+    def decode_run_length(self, data):
+        return "".join(chr(data[i + 1]) * data[i] for i in range(0, len(data), 2))
+
+
+def read_map(file_name):
+    f = Reader(file_name)
+    d = Decoder(f)
+
+    try:
+        if(f.read("string") != "CELESTE MAP"):
+            raise ValueError("%s is not a Celeste map!" % file_name)
+
+        package = f.read("string")
+        lookup = [f.read("string") for i in range(0, f.read("uint16"))]
+
+        data = d.decode_element(lookup)
+        data["_package"] = package
+    finally:
+        f.close()
+
+    return data
+
+
 class CelesteMap():
-    def __init__(self, file_name="./custom_map.bin"):
+    def __init__(self, file_name="./custom_map.bin", background=False):
         self.header = "CELESTE MAP"
 
-        self.f = Writer(file_name)
+        self.f = Writer(file_name, background)
         self.e = Encoder(self.f)
 
         self.f.write(self.header)
@@ -218,19 +456,28 @@ class CelesteMap():
         if(data is None or not isinstance(data, World)):
             raise Exception("Data cannot be None!")
 
-        seen = {}
-        data = data.to_formatted_data()
+        try:
+            seen = {}
+            data = data.to_formatted_data()
 
-        self.e.populate_encode_key_names(data, seen)
+            self.e.populate_encode_key_names(data, seen)
 
-        lookup = list(seen.keys())
-        lookup_dict = {k: i for (i, k) in enumerate(lookup)}
+            lookup = list(seen.keys())
+            lookup_dict = {k: i for (i, k) in enumerate(lookup)}
 
-        self.f.write(data["_package"], "string")
-        self.f.write(len(lookup), "uint16")
+            self.f.write(data["_package"], "string")
+            self.f.write(len(lookup), "uint16")
 
-        [self.f.write(l, "string") for l in lookup]
-        self.e.encode_element(data, lookup_dict)
+            [self.f.write(l, "string") for l in lookup]
+            self.e.encode_element(data, lookup_dict)
+        except BaseException:
+            # still stop the writer (and its thread) but keep the error that
+            # actually broke the encoding
+            try:
+                self.close()
+            except BaseException:
+                pass
+            raise
 
         self.close()
 
@@ -329,7 +576,7 @@ class Room():
 
     count = 0
 
-    def __init__(self, name="room_0", size=(40, 23), pos=(0, 0)):
+    def __init__(self, name="room_0", size=(40, 23), pos=(0, 0), work_dir=None, resume=False, fg=None, bg=None):
         self.data = {
             "position": [pos[0], pos[1]],
             "_size": [size[0] * 8, size[1] * 8],
@@ -361,13 +608,21 @@ class Room():
             "cameraOffsetY": 0
         }
 
-        self.room_grid_fg = Shape.Rect(
-            (size[0], size[1]), (size[0], size[1])).to_tiles()
-        self.room_grid_bg = Shape.Rect(
-            (size[0], size[1]), (size[0], size[1])).to_tiles()
+        # grids passed in (e.g. SparseTiles or a FrameStrip) are used as is
+        self.room_grid_fg = fg if fg is not None else Room.new_grid(
+            name + "_fg.grid", size, work_dir, resume)
+        self.room_grid_bg = bg if bg is not None else Room.new_grid(
+            name + "_bg.grid", size, work_dir, resume)
 
         Room.count += 1
 
+    def new_grid(file_name, size, work_dir=None, resume=False):
+        if(work_dir is None):
+            return Shape.Rect((size[0], size[1]), (size[0], size[1])).to_tiles()
+
+        # grid lives on disk instead of in memory
+        return MappedTiles(os.path.join(work_dir, file_name), size, resume=resume)
+
     def to_formatted_data(self):
         res = {}
 
@@ -386,11 +641,11 @@ class Room():
         res["__children"] = [
             {
                 "__name": "solids",
-                "innerText": self.room_grid_fg.to_tile_string("0", "")
+                "innerText": self.room_grid_fg.to_tile_text("0", "")
             },
             {
                 "__name": "bg",
-                "innerText": self.room_grid_bg.to_tile_string("0", "")
+                "innerText": self.room_grid_bg.to_tile_text("0", "")
             },
             {
                 "__name": "objtiles",
@@ -429,11 +684,17 @@ class Room():
     def add_entity(self, entity):
         self.data["entities"].append(entity)
 
-    def add_tiles(self, tiles, loc="fg"):
+    def add_tiles(self, tiles, loc="fg", origin=(0, 0)):
         if(loc == "fg"):
-            self.room_grid_fg.set_tiles(tiles)
+            self.room_grid_fg.set_tiles(tiles, origin)
         else:
-            self.room_grid_bg.set_tiles(tiles)
+            self.room_grid_bg.set_tiles(tiles, origin)
+
+    def flush(self, loc=None):
+        if(loc != "bg"):
+            self.room_grid_fg.flush()
+        if(loc != "fg"):
+            self.room_grid_bg.flush()
 
     def add_triggers(self, trigger):
         self.data["triggers"].append(trigger)
@@ -545,11 +806,14 @@ class Tiles():
     def __init__(self, array):
         self.tile_array = array
 
-    def set_tiles(self, tile):
-        for r in range(0, len(self.tile_array)):
-            for c in range(0, len(self.tile_array[0])):
-                self.tile_array[r][c] = tile[r][c] if str(
-                    tile[r][c]) != "0" else self.tile_array[r][c]
+    def set_tiles(self, tile, origin=(0, 0)):
+        x, y = origin
+
+        for r in range(0, len(tile)):
+            row = tile[r]
+            for c in range(0, len(row)):
+                self.tile_array[y + r][x + c] = row[c] if str(
+                    row[c]) != "0" else self.tile_array[y + r][x + c]
 
         return self
 
@@ -576,6 +840,12 @@ class Tiles():
 
         return "\n".join(res)
 
+    def to_tile_text(self, empty="0", sep=","):
+        return self.to_tile_string(empty, sep)
+
+    def flush(self):
+        return self
+
     def __getitem__(self, key):
         return self.tile_array[key]
 
@@ -589,6 +859,218 @@ class Tiles():
         return len(self.tile_array)
 
 
+def encode_tile_row(row):
+    text = "".join(str(t) for t in row)
+
+    if(len(text) != len(row)):
+        raise ValueError("Tiles must be a single character!")
+
+    return np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+
+
+def decode_tile_row(row):
+    return row.tobytes().decode("ascii")
+
+
+class RowTiles():
+    # grid of size (w, h) that hands out its rows as arrays of tile
+    # characters from tile_rows(), which is all TileText needs to write it
+
+    @property
+    def shape(self):
+        return (self.size[1], self.size[0])
+
+    def tile_rows(self):
+        return iter([])
+
+    def to_tile_string(self, empty="0", sep=","):
+        return "\n".join(self.to_tile_text(empty, sep).rows())
+
+    def to_tile_text(self, empty="0", sep=","):
+        return TileText(self, sep)
+
+    def flush(self):
+        return self
+
+
+class MappedTiles(RowTiles, Tiles):
+    # tile grid kept in a memory mapped file, one byte per tile, so a room
+    # can be bigger than memory. resume reopens an existing file as is
+    # instead of clearing it
+
+    def __init__(self, file_name, size, fill=0, resume=False):
+        shape = (size[1], size[0])
+
+        if(resume):
+            if(not os.path.exists(file_name)):
+                raise IOError("Cannot find %s to resume from!" % file_name)
+
+            self.tile_array = np.memmap(
+                file_name, dtype=np.uint8, mode="r+", shape=shape)
+        else:
+            self.tile_array = np.memmap(
+                file_name, dtype=np.uint8, mode="w+", shape=shape)
+            self.tile_array[:] = ord(str(fill))
+
+        self.file_name = file_name
+
+    @property
+    def shape(self):
+        return self.tile_array.shape
+
+    def tile_rows(self):
+        return iter(self.tile_array)
+
+    def set_tiles(self, tile, origin=(0, 0)):
+        x, y = origin
+        empty = ord("0")
+
+        for r in range(0, len(tile)):
+            row = encode_tile_row(tile[r])
+            dest = self.tile_array[y + r, x: x + len(row)]
+            dest[:] = np.where(row != empty, row, dest)
+
+        return self
+
+    def flush(self):
+        self.tile_array.flush()
+        return self
+
+    def __getitem__(self, key):
+        return list(decode_tile_row(self.tile_array[key]))
+
+    def __setitem__(self, key, value):
+        self.tile_array[key] = encode_tile_row(value)
+
+
+class SparseTiles(RowTiles):
+    # tile grid that only remembers what was placed on it and builds each
+    # row when it is asked for, for layers that are mostly empty
+
+    def __init__(self, size, fill=0):
+        self.size = size
+        self.fill = fill
+        self.pieces = []
+
+    def tile_rows(self):
+        w, h = self.size
+        empty = ord("0")
+
+        for r in range(0, h):
+            row = np.full(w, ord(str(self.fill)), dtype=np.uint8)
+
+            for (x, y), block in self.pieces:
+                if(y <= r < y + len(block)):
+                    dest = row[x: x + len(block[r - y])]
+                    src = block[r - y][:len(dest)]
+                    dest[:] = np.where(src != empty, src, dest)
+
+            yield row
+
+    def set_tiles(self, tile, origin=(0, 0)):
+        self.pieces.append(
+            (origin, [encode_tile_row(tile[r]) for r in range(0, len(tile))]))
+
+        return self
+
+
+class FrameStrip(RowTiles):
+    # bg layer made of frames laid side by side, every stride tiles starting
+    # at origin. frames are kept bit packed (1 = "b", 0 = "1") and each row
+    # of the room is only put together when the map is written
+
+    def __init__(self, size, frame_size, origin, stride):
+        self.size = size
+        self.frame_size = frame_size
+        self.origin = origin
+        self.stride = stride
+        self.frames = []
+
+    def add_frame(self, mask):
+        fw, fh = self.frame_size
+
+        if(mask.shape != (fh, fw)):
+            raise ValueError("Frame must be %sx%s!" % (fw, fh))
+
+        self.frames.append(np.packbits(mask, axis=1))
+
+    def tile_rows(self):
+        w, h = self.size
+        fw, fh = self.frame_size
+        x, y = self.origin
+        count = len(self.frames)
+
+        if(count and x + self.stride * (count - 1) + fw > w):
+            raise ValueError("Frames do not fit in the room!")
+
+        frames = np.stack(self.frames) if count else None
+        blank = np.full(max(w, x + self.stride * count),
+                        ord("0"), dtype=np.uint8)
+
+        for r in range(0, h):
+            if(not count or not (y <= r < y + fh)):
+                yield blank[:w]
+                continue
+
+            row = blank.copy()
+            bits = np.unpackbits(frames[:, r - y], axis=1, count=fw)
+
+            strip = row[x: x + self.stride * count].reshape(count, self.stride)
+            strip[:, :fw] = np.where(bits, ord("b"), ord("1"))
+
+            yield row[:w]
+
+    def set_tiles(self, tile, origin=(0, 0)):
+        raise ValueError("Tiles cannot be added to a frame strip!")
+
+
+class LazyText():
+    # text that is produced one row at a time when the map is written rather
+    # than being built up front, rows are joined with newlines
+
+    def rows(self):
+        return iter([])
+
+    def chunks(self):
+        first = True
+
+        for row in self.rows():
+            if(not first):
+                yield "\n"
+            first = False
+            yield row
+
+    def __len__(self):
+        length = -1
+
+        for row in self.rows():
+            length += len(row) + 1
+
+        return max(length, 0)
+
+
+class TileText(LazyText):
+    # text of a RowTiles grid (MappedTiles, SparseTiles, FrameStrip). rows
+    # are always written out in full, the same as Tiles.to_tile_string does
+    # for the number filled grids a Room starts with
+
+    def __init__(self, tiles, sep=""):
+        self.tiles = tiles
+        self.sep = sep
+
+    def rows(self):
+        for row in self.tiles.tile_rows():
+            row = decode_tile_row(row)
+            yield self.sep.join(row) if self.sep else row
+
+    def __len__(self):
+        rows, cols = self.tiles.shape
+        if(not rows or not cols):
+            return max(rows - 1, 0)
+
+        return rows * (cols + len(self.sep) * (cols - 1) + 1) - 1
+
+
 class ObjTiles(Tiles):
     def __init__(self, origin, size, type="Air"):
         Tiles.__init__(self, origin, size, type)
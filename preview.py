@@ -0,0 +1,184 @@
+import argparse
+import math
+import re
+
+import numpy as np
+
+import map
+
+# size of the game's screen in pixels, tiles are 8x8
+screen = (320, 180)
+
+# grey level each tile is drawn with, anything not listed is drawn light grey
+colours = {
+    "0": 96,
+    "1": 0,
+    "b": 255,
+}
+
+
+def grid_from_text(text):
+    # turns an innerText (a string or a map.LazyText) into an array of tile
+    # characters, short rows are filled with air
+    rows = text.split("\n") if isinstance(text, str) else list(text.rows())
+    grid = np.full((len(rows), max([len(r) for r in rows] + [0])),
+                   ord("0"), dtype=np.uint8)
+
+    for i, row in enumerate(rows):
+        grid[i, :len(row)] = np.frombuffer(row.encode("ascii"), dtype=np.uint8)
+
+    return grid
+
+
+def grid_from_room(room, loc="bg"):
+    grid = room.room_grid_fg if loc == "fg" else room.room_grid_bg
+    return grid_from_text(grid.to_tile_text("0", ""))
+
+
+def grid_from_bin(file_name, loc="bg", room=0):
+    data = map.read_map(file_name)
+
+    levels = [c for c in data["__children"] if c["__name"] == "levels"][0]
+    level = levels["__children"][room]
+    name = "solids" if loc == "fg" else "bg"
+
+    return grid_from_text([c for c in level["__children"] if c["__name"] == name][0]["innerText"])
+
+
+def read_camera(file_name):
+    # pulls the camera moves back out of a cutscene.lua made by badapple.py
+    with open(file_name, "r") as f:
+        code = f.read()
+
+    loop = re.search(r"for i=0,(\d+),(\d+) do", code)
+    y = re.search(r"cam\.Y = ([-\d.e]+)", code)
+    zoom = re.search(r"cam\.Zoom = ([-\d.e]+)", code)
+    delay = re.search(r"wait\((?:holds\[n\] or )?([-\d.e]+)\)", code)
+    holds = re.search(r"local holds = \{([^}]*)\}", code)
+
+    if(loop is None or y is None or delay is None):
+        raise ValueError("%s does not look like a bad apple cutscene!" % file_name)
+
+    return {
+        "x": int(loop.group(1)),
+        "step": int(loop.group(2)),
+        "y": float(y.group(1)),
+        "zoom": float(zoom.group(1)) if zoom is not None else 1,
+        "delay": float(delay.group(1)),
+        "holds": [float(d) for d in holds.group(1).split(",") if d.strip()] if holds is not None else None,
+    }
+
+
+def camera_views(grid, camera, every=1):
+    # every tile the camera can see at each step of moveCam, as one
+    # (steps, rows, cols) array taken out of the grid in one go
+    xs = np.arange(0, camera["x"] + 1, camera["step"])[::every] // 8
+    size = (int(math.ceil(screen[0] / camera["zoom"] / 8)),
+            int(math.ceil(screen[1] / camera["zoom"] / 8)))
+
+    rows = int(camera["y"] // 8) + np.arange(size[1])
+    cols = xs[:, None] + np.arange(size[0])
+
+    # anything off the edge of the room is drawn as air
+    padded = np.full((grid.shape[0] + 1, grid.shape[1] + 1),
+                     ord("0"), dtype=np.uint8)
+    padded[:-1, :-1] = grid
+
+    rows = np.where((rows >= 0) & (rows < grid.shape[0]), rows, -1)
+    cols = np.where((cols >= 0) & (cols < grid.shape[1]), cols, -1)
+
+    return padded[rows[None, :, None], cols[:, None, :]]
+
+
+def step_delays(camera, count, every=1):
+    # how long each drawn step stays on screen, frames kept with --change
+    # have their own hold times and the rest use the cutscene's delay
+    holds = camera.get("holds") or []
+    delays = [holds[i] if i < len(holds) else camera["delay"]
+              for i in range(0, count * every)]
+
+    return [sum(delays[i: i + every]) for i in range(0, count * every, every)]
+
+
+def to_image(views, scale=2):
+    lookup = np.full(256, 192, dtype=np.uint8)
+    for tile, colour in colours.items():
+        lookup[ord(tile)] = colour
+
+    image = lookup[views]
+    return image.repeat(scale, axis=-2).repeat(scale, axis=-1)
+
+
+def contact_sheet(images, columns=8, border=1):
+    count, h, w = images.shape
+    rows = int(math.ceil(count / columns))
+
+    sheet = np.full((rows * columns, h + border, w + border),
+                    255, dtype=np.uint8)
+    sheet[:count, :h, :w] = images
+
+    return sheet.reshape(rows, columns, h + border, w + border).transpose(
+        0, 2, 1, 3).reshape(rows * (h + border), columns * (w + border))
+
+
+def write_sheet(images, file_name, columns=8):
+    import imageio
+
+    imageio.imwrite(file_name, contact_sheet(images, columns))
+
+
+def write_gif(images, file_name, delays):
+    import imageio
+
+    # duration is in milliseconds
+    imageio.mimsave(file_name, list(images),
+                    duration=[d * 1000 for d in delays], loop=0)
+
+
+def preview(grid, camera, sheet=None, gif=None, every=1, scale=2, columns=8):
+    images = to_image(camera_views(grid, camera, every), scale)
+
+    if(sheet is not None):
+        write_sheet(images, sheet, columns)
+    if(gif is not None):
+        write_gif(images, gif, step_delays(camera, len(images), every))
+
+    return images
+
+
+def setup(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Draws what the camera shows at each step of a bad apple map")
+
+    parser.add_argument("--bin", "-b", type=str,
+                        help="Path to the map's .bin", dest="bin")
+    parser.add_argument("--cutscene", "-cs", type=str,
+                        help="Path to the map's cutscene.lua", dest="cs")
+    parser.add_argument("--sheet", "-o", type=str, default=None,
+                        help="Write a contact sheet of every step to this png", dest="sheet")
+    parser.add_argument("--gif", "-g", type=str, default=None,
+                        help="Write the steps as an animation to this gif", dest="gif")
+    parser.add_argument("--every", "-e", type=int, default=1,
+                        help="Only draw every nth step", dest="every")
+    parser.add_argument("--scale", "-s", type=int, default=2,
+                        help="Pixels per tile", dest="scale")
+    parser.add_argument("--columns", "-col", type=int, default=8,
+                        help="Steps per row of the contact sheet", dest="columns")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = setup(argv)
+
+    camera = read_camera(args.cs)
+    images = preview(grid_from_bin(args.bin), camera, args.sheet,
+                     args.gif, args.every, args.scale, args.columns)
+
+    delays = step_delays(camera, len(images), args.every)
+    print("drew %s steps of %sx%s pixels over %ss" % (
+        len(images), images.shape[2], images.shape[1], round(sum(delays), 3)))
+
+
+if __name__ == "__main__":
+    main()